@@ -1,7 +1,6 @@
 from typing import Sequence, Iterator
 
 import argparse
-import io
 import json
 import pathlib
 import zipfile
@@ -22,24 +21,22 @@ def catalog_downloader():
     def _expand_years(years: Sequence[str]) -> Iterator[str]:
         for year in years:
             if '-' in year:
-                first_year, last_year = map(int, year.split('-'))
-                yield from map(str, range(first_year, last_year+1))
+                first_year, last_year = year.split('-')
+                yield from (str(y) for y in range(int(first_year), int(last_year)+1))
             else:
                 yield year
 
     p, args = _parse_args()
 
-    output_zip = zipfile.ZipFile(args.output, mode='a', compression=zipfile.ZIP_DEFLATED)
+    output_zip = zipfile.ZipFile(args.output, mode='a', compression=zipfile.ZIP_DEFLATED, compresslevel=3)
 
     if args.dry_run:
         for year in _expand_years(args.years):
-            print(f'page.download_catalog({repr(year)})')
+            print(f"page.download_catalog('{year}')")
         return
 
     for year, pageno, parsed_catalog in page.download_catalog(_expand_years(args.years)):
-        with output_zip.open(f'{year}_{pageno}.json', mode='w') as output_binary:
-            with io.TextIOWrapper(output_binary, encoding='utf-8') as output:
-                json.dump(parsed_catalog, output)
+        output_zip.writestr(f'{year}_{pageno}.json', json.dumps(parsed_catalog, ensure_ascii=False).encode('utf-8'))
 
 def metadata_downloader():
     def _parse_args():
@@ -88,8 +85,10 @@ def book_converter():
         p = argparse.ArgumentParser('Rip a fully downloaded FlipViewer eBook as PDF.')
         p.add_argument('metadata', type=pathlib.Path, help='Metadata XML file. Must be in a valid FVX prefix.')
         p.add_argument('output', type=pathlib.Path, help='Path to output.')
+        p.add_argument('-j', '--jobs', type=int, default=None, help='Number of pages to render in parallel. Defaults to the number of CPUs.')
+        p.add_argument('--tmp-dir', type=pathlib.Path, default=None, help='Where to keep intermediate files. Use a tmpfs (e.g. /dev/shm) to avoid disk round-trips.')
         return p, p.parse_args()
     
     p, args = _parse_args()
 
-    converter.convert_book(args.metadata, args.output)
+    converter.convert_book(args.metadata, args.output, jobs=args.jobs, tmp_dir=args.tmp_dir)
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
-from typing import Optional, Literal, List, Sequence, cast
+from typing import Optional, Literal, Dict, List, Sequence, Tuple
 
+import concurrent.futures
+import io
+import itertools
+import math
+import os
 import subprocess
 import pathlib
+import shutil
 import tempfile
 
 from lxml import etree
 import tqdm
 import pikepdf
 
-from .downloader import extract_license_url, extract_page
+from .downloader import MetadataView, parse_metadata
 from . import crypteww
 
 
@@ -65,84 +71,175 @@ class FFDecWrapper:
             return output_pdf
         return None
 
+    def render_directory_frames_as_pdf(self, input_dir: pathlib.Path, output_path: pathlib.Path) -> Dict[pathlib.Path, Optional[pathlib.Path]]:
+        '''
+        Render every SWF file in input_dir with a single ffdec run, so the JVM
+        only starts once.
 
-def get_book_master_passphrase_from_license(license_path: pathlib.Path):
+        For directory input ffdec exports each file into its own
+        <output_path>/<input file name> directory (see the -export handling in
+        JPEXS CommandLineArgumentParser). Files it failed to export map to
+        None.
+        '''
+        self.call([
+            '-format',
+            'frame:pdf',
+            '-export',
+            'frame',
+            str(output_path.absolute()),
+            str(input_dir.absolute()),
+        ])
+
+        result: Dict[pathlib.Path, Optional[pathlib.Path]] = {}
+        for input_file in input_dir.glob('*.swf'):
+            output_pdf = output_path / input_file.name / 'frames.pdf'
+            result[input_file] = output_pdf if output_pdf.is_file() else None
+        return result
+
+
+def _read_license_security_contents(license_path: pathlib.Path, tags: Sequence[str]) -> Dict[str, List[Optional[str]]]:
+    contents: Dict[str, List[Optional[str]]] = {tag: [] for tag in tags}
     with license_path.open('rb') as license_file:
-        license_root = etree.parse(license_file).getroot()
+        for _event, elem in etree.iterparse(license_file, tag=tags):
+            ancestors = [ancestor.tag for ancestor in elem.iterancestors()]
+            if ancestors == ['security', 'certificate', 'package']:
+                contents[elem.tag].append(elem.get('content'))
+    return contents
 
-    encryption_xp = cast(List[etree._Element], license_root.xpath('/package/certificate/security/encryption'))
-    if len(encryption_xp) != 1:
+def _parse_license(license_path: pathlib.Path) -> Tuple[str, List[Optional[str]]]:
+    security = _read_license_security_contents(license_path, ('encryption', 'password'))
+
+    encryption_contents = security['encryption']
+    if len(encryption_contents) != 1:
         raise RuntimeError('Invalid use of encryption tag.')
 
-    epassphrase = encryption_xp[0].get('content')
+    epassphrase = encryption_contents[0]
     if epassphrase is None:
         raise RuntimeError('Encryption tag does not contain the encrypted passphrase.')
 
-    return crypteww.decrypt_offline_license_passphrase(epassphrase)
+    return crypteww.decrypt_offline_license_passphrase(epassphrase), security['password']
 
-def get_book_access_code_from_license(license_path: pathlib.Path):
-    # TODO this is a bit ugly. Maybe refactor it a bit?
-    passphrase = get_book_master_passphrase_from_license(license_path)
+def get_book_master_passphrase_from_license(license_path: pathlib.Path):
+    passphrase, _password_contents = _parse_license(license_path)
+    return passphrase
 
-    with license_path.open('rb') as license_file:
-        license_root = etree.parse(license_file).getroot()
+def get_book_access_code_from_license(license_path: pathlib.Path):
+    passphrase, password_contents = _parse_license(license_path)
 
-    password_xp = cast(List[etree._Element], license_root.xpath('/package/certificate/security/password'))
-    if len(password_xp) != 1:
+    if len(password_contents) != 1:
         raise RuntimeError('Invalid use of password tag.')
 
-    epassword = password_xp[0].get('content')
+    epassword = password_contents[0]
     if epassword is None:
         raise RuntimeError('Password tag does not contain the encrypted password.')
 
     return crypteww.decrypt_access_code_passphrase(passphrase, epassword)
 
-def get_book_master_passphrase_from_metadata(book_path: pathlib.Path, metadata_xml: etree._Element):
-    license_path = book_path / extract_license_url(metadata_xml)
+def get_book_master_passphrase_from_metadata(book_path: pathlib.Path, metadata: MetadataView):
+    license_path = book_path / metadata['license_url']
     return get_book_master_passphrase_from_license(license_path)
 
-def convert_book(book_xml_path: pathlib.Path, output_path: pathlib.Path, output_type: Literal['cbz', 'pdf'] = 'pdf'):
-    with book_xml_path.open('rb') as metadata_xml_file:
-        metadata_xml = etree.parse(metadata_xml_file).getroot()
+def _render_batch(pages: Sequence[Tuple[pathlib.Path, str]], key: bytes, iv: bytes, work_dir: pathlib.Path) -> bytes:
+    '''
+    Decrypt, render and merge a run of consecutive pages. Runs inside a worker
+    process so returns the merged output as bytes.
+    '''
+    objs_dir = work_dir / 'objs'
+    objs_dir.mkdir(parents=True)
+    flash_pages: List[Tuple[pathlib.Path, pathlib.Path]] = []
+
+    # Prepare input files
+    for index, (page_path, mime_type) in enumerate(pages):
+        if mime_type != 'application/x-shockwave-flash':
+            #raise RuntimeError(f'Unhandled page MIME type {mime_type} for file {page_path}.')
+            print(f'Unhandled page MIME type {mime_type} for file {page_path}. Skipped.')
+            continue
+
+        decrypted_obj_path = objs_dir / f'{index:04d}.swf'
+        decrypted_obj_path.write_bytes(crypteww.decrypt_swf_obj_bytes_prepared(key, iv, page_path.read_bytes()))
+        flash_pages.append((page_path, decrypted_obj_path))
+
+    # Render the frames of the whole batch in one go
+    ffdec = FFDecWrapper('ffdec')
+    frames: Dict[pathlib.Path, Optional[pathlib.Path]] = {}
+    if len(flash_pages) != 0:
+        # output-type specific
+        frames = ffdec.render_directory_frames_as_pdf(objs_dir, work_dir / 'output')
 
-    book_prefix = book_xml_path.parent
-    passphrase = get_book_master_passphrase_from_metadata(book_prefix, metadata_xml)
+    # Retry anything ffdec failed to produce in the batch run on its own.
+    missing = [decrypted_obj_path for _page_path, decrypted_obj_path in flash_pages if frames.get(decrypted_obj_path) is None]
+    if len(missing) != 0:
+        print(f'Batch rendering produced no output for {len(missing)} page(s). Rendering them one by one.')
+    for decrypted_obj_path in missing:
+        # output-type specific
+        frames[decrypted_obj_path] = ffdec.render_frames_as_pdf(decrypted_obj_path, work_dir / 'single' / decrypted_obj_path.stem)
 
     # output-type specific
-    output = pikepdf.Pdf.new()
-
-    with tempfile.TemporaryDirectory() as work_dir_name, output:
-        work_dir = pathlib.Path(work_dir_name)
-        pages = tuple(extract_page(metadata_xml))
-
-        for page_url, mime_type in tqdm.tqdm(pages):
-            page_path = book_prefix / pathlib.PurePosixPath(page_url)
-            decrypted_obj_path = work_dir / 'decrypted_obj'
-            frame: Optional[pathlib.Path] = None
-
-            # Prepare input file
-            with page_path.open('rb') as page_file, decrypted_obj_path.open('wb') as decrypted_obj:
-                crypteww.decrypt_swf_obj_file(passphrase, page_file, decrypted_obj)
-
-            # Render the frame
-            if mime_type == 'application/x-shockwave-flash':
-                ffdec = FFDecWrapper('ffdec')
-                # output-type specific
-                frame = ffdec.render_frames_as_pdf(decrypted_obj_path, work_dir / 'output')
-            else:
-                #raise RuntimeError(f'Unhandled page MIME type {mime_type} for file {page_path}.')
-                print(f'Unhandled page MIME type {mime_type} for file {page_path}. Skipped.')
-                continue
-
+    batch_output = pikepdf.Pdf.new()
+    with batch_output:
+        for page_path, decrypted_obj_path in flash_pages:
+            frame = frames.get(decrypted_obj_path)
             if frame is None:
                 raise RuntimeError(f'Failed to produce an output for {page_path}.')
 
-            # output-type specific
             with pikepdf.Pdf.open(frame) as frame_pdf:
                 if len(frame_pdf.pages) > 1:
                     print(f'Multiple page generated for {page_path}, including all of them.')
-                output.pages.extend(frame_pdf.pages)
-            frame.unlink()
+                batch_output.pages.extend(frame_pdf.pages)
+
+        rendered = io.BytesIO()
+        batch_output.save(rendered)
+
+    # Nothing in the work directory is needed anymore. Free it early in case
+    # it lives on a size-limited tmpfs.
+    shutil.rmtree(work_dir)
+    return rendered.getvalue()
+
+def convert_book(book_xml_path: pathlib.Path, output_path: pathlib.Path, output_type: Literal['cbz', 'pdf'] = 'pdf', jobs: Optional[int] = None, tmp_dir: Optional[pathlib.Path] = None):
+    with book_xml_path.open('rb') as metadata_xml_file:
+        metadata = parse_metadata(metadata_xml_file)
+
+    book_prefix = book_xml_path.parent
+    passphrase = get_book_master_passphrase_from_metadata(book_prefix, metadata)
+
+    # Every page is encrypted with the same passphrase.
+    key = crypteww.derive_key(passphrase)
+    iv = crypteww.derive_iv(key)
+
+    workers = jobs if jobs is not None else (os.cpu_count() or 1)
+
+    # output-type specific
+    output = pikepdf.Pdf.new()
+
+    # ffdec can only read from and write to files, so the decrypted pages and
+    # rendered frames have to go through a work directory. Pointing tmp_dir at
+    # a tmpfs keeps them off the disk entirely.
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as work_dir_name, output, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        work_dir = pathlib.Path(work_dir_name)
+        pages = [(book_prefix / pathlib.PurePosixPath(page_url), mime_type) for page_url, mime_type in metadata['pages']]
+
+        # Pages are independent from each other, so each worker renders and
+        # merges one run of them. Only merging the batches into the final
+        # output needs to happen in order, which map() preserves. This also
+        # means the main process only opens one PDF per worker instead of one
+        # per page.
+        batch_size = max(1, math.ceil(len(pages) / workers))
+        batches = [pages[start:start+batch_size] for start in range(0, len(pages), batch_size)]
+        rendered_batches = executor.map(
+            _render_batch,
+            batches,
+            itertools.repeat(key),
+            itertools.repeat(iv),
+            (work_dir / f'{index:04d}' for index in range(len(batches))),
+        )
+
+        with tqdm.tqdm(total=len(pages)) as progress:
+            for batch, rendered in zip(batches, rendered_batches):
+                # output-type specific
+                with pikepdf.Pdf.open(io.BytesIO(rendered)) as batch_pdf:
+                    output.pages.extend(batch_pdf.pages)
+                progress.update(len(batch))
 
         # output-type specific
         output.remove_unreferenced_resources()
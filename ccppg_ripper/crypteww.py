@@ -4,9 +4,12 @@ from __future__ import annotations
 from typing import Tuple, BinaryIO, Type
 
 import base64
+import functools
 import hashlib
-import io
+import itertools
+import operator
 import shutil
+import struct
 
 import obsolete_cryptography as ocrypt
 
@@ -17,6 +20,8 @@ BytesLike = bytes | bytearray | memoryview
 safersk128 = ocrypt.CipherModule('safer-sk128')
 ripemd256 = ocrypt.HashModule('ripemd256')
 
+_block = struct.Struct('>Q')
+
 
 class SaferSK128FVCBC:
     '''
@@ -33,33 +38,21 @@ class SaferSK128FVCBC:
         self._key = key
         self._iv = iv
         self._ctx = safersk128.new(key, 'ecb')
-        self._feedback = int.from_bytes(iv, 'big')
+        self._feedback = _block.unpack(iv)[0]
         self._state = 'initialized'
 
-    def _update_feedback(self, block: bytes):
-        block_int = int.from_bytes(block, 'big')
-        self._feedback ^= block_int
-
-    def _toggle_cbc(self, data):
-        return (int.from_bytes(data, 'big') ^ self._feedback).to_bytes(8, 'big')
-
     def _split_data(self, data: BytesLike) -> Tuple[bytes, bytes]:
         # TODO figure out how to pass memoryviews to cython
         aligned_size = (len(data) // 8) * 8
-        unaligned_size = len(data) - aligned_size
-        aligned_data = memoryview(data)[:aligned_size]
-        unaligned_data = memoryview(data)[aligned_size:]
-        return aligned_data.tobytes(), unaligned_data.tobytes()
+        view = memoryview(data)
+        return view[:aligned_size].tobytes(), view[aligned_size:].tobytes()
 
     @classmethod
     def from_passphrase(cls: Type[SaferSK128FVCBC], passphrase: str) -> SaferSK128FVCBC:
-        key = derive_key(passphrase)
-        iv = derive_iv(key)
-
-        return cls(key, iv)
+        return cls(*_derive_key_iv(passphrase))
 
     def create_cfb_finisher(self):
-        return safersk128.new(self._key, 'ncfb', IV=self._feedback.to_bytes(8, 'big'))
+        return safersk128.new(self._key, 'ncfb', IV=_block.pack(self._feedback))
 
     def encrypt(self, data: BytesLike) -> bytes:
         if len(data) % 8 != 0:
@@ -70,24 +63,26 @@ class SaferSK128FVCBC:
             raise RuntimeError('Cannot encrypt using an decryption context.')
         self._state = 'encrypting'
 
-        data_io = io.BytesIO(data)
-        ct_io = io.BytesIO()
-
-        while True:
-            pt = data_io.read(8)
-            if len(pt) < 8:
-                break
+        # Bind the hot calls locally. The context is already obsolete_cryptography's
+        # Cython wrapper around libmcrypt so there's no further shim to skip.
+        ecb_encrypt = self._ctx.encrypt
+        pack = _block.pack
+        unpack_from = _block.unpack_from
+        feedback = self._feedback
+        ct = bytearray(len(data))
 
+        for offset in range(0, len(data), 8):
             # Do the normal CBC op
-            pt_cbc = self._toggle_cbc(pt)
-            ct = self._ctx.encrypt(pt_cbc)
-            ct_io.write(ct)
+            pt_cbc = pack(unpack_from(data, offset)[0] ^ feedback)
+            ct_block = ecb_encrypt(pt_cbc)
+            ct[offset:offset+8] = ct_block
 
             # Propagation with feedback = feedback ^ ciphertext (instead of
             # feedback = plaintext ^ ciphertext in regular PCBC mode)
-            self._update_feedback(ct)
+            feedback ^= unpack_from(ct_block)[0]
 
-        return ct_io.getvalue()
+        self._feedback = feedback
+        return bytes(ct)
 
     def decrypt(self, data: BytesLike) -> bytes:
         if len(data) % 8 != 0:
@@ -98,48 +93,42 @@ class SaferSK128FVCBC:
             raise RuntimeError('Cannot decrypt using an encryption context.')
         self._state = 'decrypting'
 
-        data_io = io.BytesIO(data)
-        pt_io = io.BytesIO()
+        if len(data) == 0:
+            return b''
 
-        while True:
-            ct = data_io.read(8)
-            if len(ct) < 8:
-                break
+        # Unlike encryption, the feedback here only depends on the ciphertext,
+        # so the whole buffer can go through ECB in one call and the chaining
+        # can be undone afterwards.
+        blocks_fmt = f'>{len(data) // 8}Q'
+        ct_blocks = struct.unpack(blocks_fmt, data)
+        pt_cbc_blocks = struct.unpack(blocks_fmt, self._ctx.decrypt(bytes(data)))
 
-            # Do the normal CBC op
-            pt_cbc = self._ctx.decrypt(ct)
-            pt = self._toggle_cbc(pt_cbc)
-            pt_io.write(pt)
+        # Propagation with feedback = feedback ^ ciphertext (instead of
+        # feedback = plaintext ^ ciphertext in regular PCBC mode)
+        feedback = itertools.accumulate(ct_blocks, operator.xor, initial=self._feedback)
+        pt = struct.pack(blocks_fmt, *map(operator.xor, pt_cbc_blocks, feedback))
 
-            # Propagation with feedback = feedback ^ ciphertext (instead of
-            # feedback = plaintext ^ ciphertext in regular PCBC mode)
-            self._update_feedback(ct)
+        # map() stops as soon as pt_cbc_blocks runs out, so the feedback after
+        # the last block is still pending in the accumulator.
+        self._feedback = next(feedback)
 
-        return pt_io.getvalue()
+        return pt
 
     def encrypt_autofinish(self, data: BytesLike) -> bytes:
         if len(data) % 8 == 0:
             return self.encrypt(data)
 
-        result = io.BytesIO()
-
         aligned_data, unaligned_data = self._split_data(data)
 
-        result.write(self.encrypt(aligned_data))
-        result.write(self.create_cfb_finisher().encrypt(unaligned_data))
-        return result.getvalue()
+        return self.encrypt(aligned_data) + self.create_cfb_finisher().encrypt(unaligned_data)
 
     def decrypt_autofinish(self, data: BytesLike) -> bytes:
         if len(data) % 8 == 0:
             return self.decrypt(data)
 
-        result = io.BytesIO()
-
         aligned_data, unaligned_data = self._split_data(data)
 
-        result.write(self.decrypt(aligned_data))
-        result.write(self.create_cfb_finisher().decrypt(unaligned_data))
-        return result.getvalue()
+        return self.decrypt(aligned_data) + self.create_cfb_finisher().decrypt(unaligned_data)
 
 
 def derive_key(passphrase: str):
@@ -148,32 +137,32 @@ def derive_key(passphrase: str):
 def derive_iv(key: bytes):
     return safersk128.new(key, 'ecb').encrypt(b'\xff' * 8)
 
+@functools.lru_cache(maxsize=32)
+def _derive_key_iv(passphrase: str) -> Tuple[bytes, bytes]:
+    key = derive_key(passphrase)
+    return key, derive_iv(key)
+
 def ddmd5(data: BytesLike | str) -> str:
     '''
     Double data MD5 (md5(data+data)) used to derive the passphrase for book
     password encryption.
     Corresponding method: FVUtil.getMD5Value()
     '''
-    data_bytes = data.encode('utf-8') if isinstance(data, str) else data
-    md5 = hashlib.md5(data_bytes)
-    md5.update(data_bytes)
-    return md5.hexdigest()
+    data_bytes = data.encode('utf-8') if isinstance(data, str) else bytes(data)
+    return hashlib.md5(data_bytes + data_bytes, usedforsecurity=False).hexdigest()
 
 def derive_passphrase_access_code(passphrase: str) -> str:
     '''
     Derive passphrase used to encrypt book password from license master
     passphrase.
     '''
-    return ddmd5((passphrase + constants.PASSWORD_PASSPHRASE_SUFFIX).encode('utf-8'))
+    return ddmd5(passphrase + constants.PASSWORD_PASSPHRASE_SUFFIX)
 
 def decrypt_hex_b64_str(passphrase: str, string: str) -> str:
     '''
     Unwrap the ciphertext and decrpyt it as a UTF-8 string.
     '''
-    key = derive_key(passphrase)
-    iv = derive_iv(key)
-
-    cipher = SaferSK128FVCBC(key, iv)
+    cipher = SaferSK128FVCBC.from_passphrase(passphrase)
     ct = base64.b64decode(bytes.fromhex(string))
     pt_bytes = cipher.decrypt_autofinish(ct)
 
@@ -188,10 +177,7 @@ def encrypt_hex_b64_str(passphrase: str, string: str) -> str:
     '''
     Encrypt a string and wrap it in base64 then hex.
     '''
-    key = derive_key(passphrase)
-    iv = derive_iv(key)
-
-    cipher = SaferSK128FVCBC(key, iv)
+    cipher = SaferSK128FVCBC.from_passphrase(passphrase)
     pt_bytes = string.encode('utf-8')
     ct = cipher.encrypt_autofinish(pt_bytes)
 
@@ -211,9 +197,35 @@ def encrypt_access_code_passphrase(passphrase: str, password: str) -> str:
     password_passphrase = derive_passphrase_access_code(passphrase)
     return encrypt_hex_b64_str(password_passphrase, password)
 
-def decrypt_swf_obj_file(passphrase: str, in_file: BinaryIO, out_file: BinaryIO) -> None:
+def decrypt_swf_obj_bytes(passphrase: str, raw: BytesLike) -> bytes:
+    return decrypt_swf_obj_bytes_prepared(*_derive_key_iv(passphrase), raw)
+
+def decrypt_swf_obj_bytes_prepared(key: bytes, iv: bytes, raw: BytesLike) -> bytes:
+    '''
+    In-memory counterpart of decrypt_swf_obj_file_prepared.
+    '''
+    cipher = SaferSK128FVCBC(key, iv)
+
+    # Only the first 8KiB is encrypted.
+    return cipher.decrypt_autofinish(raw[:8192]) + raw[8192:]
+
+def encrypt_swf_obj_bytes(passphrase: str, raw: BytesLike) -> bytes:
     cipher = SaferSK128FVCBC.from_passphrase(passphrase)
 
+    # Only the first 8KiB is encrypted.
+    return cipher.encrypt_autofinish(raw[:8192]) + raw[8192:]
+
+def decrypt_swf_obj_file(passphrase: str, in_file: BinaryIO, out_file: BinaryIO) -> None:
+    decrypt_swf_obj_file_prepared(*_derive_key_iv(passphrase), in_file, out_file)
+
+def decrypt_swf_obj_file_prepared(key: bytes, iv: bytes, in_file: BinaryIO, out_file: BinaryIO) -> None:
+    '''
+    Same as decrypt_swf_obj_file but takes an already derived key and IV, so
+    callers decrypting many objects with the same passphrase only need to
+    derive them once.
+    '''
+    cipher = SaferSK128FVCBC(key, iv)
+
     block = in_file.read(8192)
     out_file.write(cipher.decrypt_autofinish(block))
 
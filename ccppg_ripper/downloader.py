@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from typing import Set, Literal, Optional, Tuple, List, Iterator, cast
+from typing import Set, Literal, Optional, Tuple, List, Iterator, TypedDict, BinaryIO
 import datetime
 import io
 import json
@@ -15,6 +15,7 @@ import zipfile
 from dateutil.parser import parse as parsedate
 from lxml import etree
 import requests
+import requests.adapters
 
 from . import constants
 from .page import BookMetadata
@@ -29,92 +30,152 @@ AssetFlags = Set[Literal[
     #'iframe',
 ]]
 
+REQUEST_TIMEOUT = 60
+
+ARIA2_OPTIONS = {
+    'max-connection-per-server': '8',
+    'split': '8',
+    'min-split-size': '1M',
+    'continue': 'true',
+}
+ARIA2_LIST_HEADER = '# Download with: aria2c -i assets.lst -j 8'
+
+# Reuse connections to the metadata server across books.
+_session = requests.Session()
+_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16))
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
 
 def prefix_from_book_metadata(book: BookMetadata) -> str:
     return f"{book['year']}_{book['month']}_{book['series']}_{book['name']}_{book['uuid']}"
 
-def extract_license_url(metadata_xml: etree._Element) -> str:
-    # TODO XPath object doesn't always have len()?
-    license_tags = cast(List[etree._Element], metadata_xml.xpath('/package/drm_enabled/certificate'))
-    if len(license_tags) != 1:
+class MetadataView(TypedDict):
+    license_url: str
+    pages: List[Tuple[str, str]]
+    thumbnails: List[str]
+    searchabletext_url: Optional[str]
+    archive_url: Optional[str]
+    has_toc: bool
+    toc_url: Optional[str]
+
+
+def _license_url_from_certificates(certificates: List[Tuple[Optional[str], Optional[str]]]) -> str:
+    if len(certificates) != 1:
         raise RuntimeError('Certificate entry must occur exactly once.')
 
-    license_tag = license_tags[0]
-    if license_tag.get('type') != '2':
+    license_type, url = certificates[0]
+    if license_type != '2':
         raise RuntimeError('Only embedded license is supported.')
 
-    url = license_tag.get('url')
     if url is None:
         raise RuntimeError('License file URL missing.')
     return url
 
-def extract_page(metadata_xml: etree._Element) -> Iterator[Tuple[str, str]]:
-    manifest_items = cast(List[etree._Element], metadata_xml.xpath('/package/manifest/item'))
-    if len(manifest_items) == 0:
-        raise RuntimeError('No pages found.')
-
-    for item in manifest_items:
-        url = item.get('href')
-        mime_type = item.get('media-type')
-
-        if url is None:
-            raise RuntimeError(f'URL is missing for item tag {item}.')
-        if mime_type is None:
-            print('MIME type is missing. Guessing from the suffix...')
-            if url.endswith('.swf'):
-                mime_type = 'application/x-shockwave-flash'
-            elif url.endswith('.png') or url.endswith('.jpg') or url.endswith('.gif'):
-                mime_type = 'image/x-flp'
-            else:
-                raise RuntimeError(f'Cannot determine MIME type for item tag {item}.')
+def _page_from_item(item: etree._Element) -> Tuple[str, str]:
+    url = item.get('href')
+    mime_type = item.get('media-type')
 
-        yield url, mime_type
+    if url is None:
+        raise RuntimeError(f'URL is missing for item tag {item}.')
+    if mime_type is None:
+        print('MIME type is missing. Guessing from the suffix...')
+        if url.endswith('.swf'):
+            mime_type = 'application/x-shockwave-flash'
+        elif url.endswith('.png') or url.endswith('.jpg') or url.endswith('.gif'):
+            mime_type = 'image/x-flp'
+        else:
+            raise RuntimeError(f'Cannot determine MIME type for item tag {item}.')
+
+    return url, mime_type
+
+def _single_or_none(values: List[Optional[str]]) -> Optional[str]:
+    return values[0] if len(values) == 1 else None
+
+def parse_metadata(metadata_file: BinaryIO) -> MetadataView:
+    '''
+    Collect everything we need from the metadata XML in a single streaming
+    pass.
+    '''
+    certificates: List[Tuple[Optional[str], Optional[str]]] = []
+    pages: List[Tuple[str, str]] = []
+    thumbnails: List[str] = []
+    text_urls: List[Optional[str]] = []
+    archive_urls: List[Optional[str]] = []
+    toc_urls: List[Optional[str]] = []
+
+    path: List[str] = []
+    for event, elem in etree.iterparse(metadata_file, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+
+        location = '/'.join(path)
+        path.pop()
+
+        if location == 'package/manifest/item':
+            pages.append(_page_from_item(elem))
+        elif location == 'package/spine/itemref':
+            thumbnail = elem.get('thumbnail')
+            if thumbnail is not None:
+                thumbnails.append(thumbnail)
+        elif location == 'package/drm_enabled/certificate':
+            certificates.append((elem.get('type'), elem.get('url')))
+        elif location == 'package/drm_enabled/searchabletext':
+            text_urls.append(elem.get('url'))
+        elif location == 'package/drm_enabled/archive':
+            archive_urls.append(elem.get('url'))
+        elif location == 'package/drm_enabled/customized/pagedescription':
+            toc_urls.append(elem.get('external'))
+
+        # Everything we need from this element has been copied out by now.
+        elem.clear(keep_tail=True)
+
+    if len(pages) == 0:
+        raise RuntimeError('No pages found.')
 
-def extract_asset_urls(metadata_xml: etree._Element, include: Optional[AssetFlags] = None):
+    return {
+        'license_url': _license_url_from_certificates(certificates),
+        'pages': pages,
+        'thumbnails': thumbnails,
+        'searchabletext_url': _single_or_none(text_urls),
+        'archive_url': _single_or_none(archive_urls),
+        'has_toc': len(toc_urls) == 1,
+        'toc_url': _single_or_none(toc_urls),
+    }
+
+def extract_asset_urls(metadata: MetadataView, include: Optional[AssetFlags] = None):
     result: List[str] = []
 
-    root = metadata_xml
-
     # Pages (required)
-    result.extend(url for url, _mime_type in extract_page(root))
+    result.extend(url for url, _mime_type in metadata['pages'])
 
     # License (required)
-    result.append(extract_license_url(metadata_xml))
+    result.append(metadata['license_url'])
 
     if include is None:
         return result
 
     # Thumbnails
     if 'thumbnails' in include:
-        thumbnail_items = cast(List[etree._Element], root.xpath('/package/spine/itemref'))
-        if len(thumbnail_items) == 0:
+        if len(metadata['thumbnails']) == 0:
             print('No thumbnails found.')
-
-        for item in thumbnail_items:
-            result.append(item.get('thumbnail'))
+        result.extend(metadata['thumbnails'])
 
     # Text
-    if 'searchabletext' in include:
-        text_items = cast(List[etree._Element], root.xpath('/package/drm_enabled/searchabletext'))
-        if len(text_items) == 1:
-            result.append(text_items[0].get('url'))
+    if 'searchabletext' in include and metadata['searchabletext_url'] is not None:
+        result.append(metadata['searchabletext_url'])
 
     # Archive
-    if 'searchabletext' in include:
-        archive_items = cast(List[etree._Element], root.xpath('/package/drm_enabled/archive'))
-        if len(archive_items) == 1:
-            result.append(archive_items[0].get('url'))
+    if 'archive' in include and metadata['archive_url'] is not None:
+        result.append(metadata['archive_url'])
 
     # TOC
     # TODO embedded TOC
-    if 'searchabletext' in include:
-        toc_items = cast(List[etree._Element], root.xpath('/package/drm_enabled/customized/pagedescription'))
-        if len(toc_items) == 1:
-            external_toc = toc_items[0].get('external')
-            if external_toc is not None:
-                result.append(external_toc)
-            else:
-                print('TOC requested but no TOC file found.')
+    if 'toc' in include and metadata['has_toc']:
+        if metadata['toc_url'] is not None:
+            result.append(metadata['toc_url'])
+        else:
+            print('TOC requested but no TOC file found.')
 
     return result
 
@@ -127,16 +188,14 @@ def fetch_metadata_xml(metadata: BookMetadata) -> Tuple[datetime.datetime, bytes
         name=metadata['name'],
     )
 
-    req = requests.get(url)
+    req = _session.get(url, headers={'Accept-Encoding': 'gzip'}, timeout=REQUEST_TIMEOUT)
     date = parsedate(req.headers['last-modified'])
 
     return date, req.content
 
 def read_catalog_zip(catalog_zip: zipfile.ZipFile) -> Iterator[BookMetadata]:
     for filename in catalog_zip.namelist():
-        with catalog_zip.open(filename, mode='r') as metadata_bytes:
-            with io.TextIOWrapper(metadata_bytes, encoding='utf-8') as metadata_file:
-                metadata: List[BookMetadata] = json.load(metadata_file)
+        metadata: List[BookMetadata] = json.loads(catalog_zip.read(filename).decode('utf-8'))
         yield from metadata
 
 def generate_url_list(prefix: str, book_prefix: pathlib.Path, files: List[str], downloader: Literal['aria2', 'wget']):
@@ -146,7 +205,9 @@ def generate_url_list(prefix: str, book_prefix: pathlib.Path, files: List[str],
         if downloader == 'aria2':
             local_prefix = book_prefix / pathlib.PurePosixPath(posixpath.dirname(file))
             lines.append(abs_url)
-            lines.append(f"    dir = {posixpath.join('.', local_prefix)}")
+            lines.append(f"    dir={posixpath.join('.', local_prefix)}")
+            lines.append(f'    out={posixpath.basename(file)}')
+            lines.extend(f'    {name}={value}' for name, value in ARIA2_OPTIONS.items())
         else:
             lines.append(abs_url)
     return '\n'.join(lines)
@@ -158,6 +219,10 @@ def generate_skel_dir_from_catalog(catalog_zip: zipfile.ZipFile, output_dir: pat
         raise ValueError('Output path is not a directory.')
     
     with (output_dir / 'assets.lst').open('w') as assets_download_list:
+        if downloader == 'aria2':
+            assets_download_list.write(ARIA2_LIST_HEADER)
+            assets_download_list.write('\n')
+
         for book in read_catalog_zip(catalog_zip):
             prefix = prefix_from_book_metadata(book)
 
@@ -179,7 +244,7 @@ def generate_skel_dir_from_catalog(catalog_zip: zipfile.ZipFile, output_dir: pat
                 metadata_xml_path.write_bytes(metadata_xml)
                 os.utime(metadata_xml_path, times=(mtime.timestamp(), mtime.timestamp()))
 
-                metadata_xml_root = etree.fromstring(metadata_xml)
+                metadata = parse_metadata(io.BytesIO(metadata_xml))
 
                 print('Sleeping...')
                 time.sleep(3 + random.expovariate(3) * 10)
@@ -187,7 +252,7 @@ def generate_skel_dir_from_catalog(catalog_zip: zipfile.ZipFile, output_dir: pat
             else:
                 print('Using cached data')
                 with metadata_xml_path.open('rb') as metadata_xml_file:
-                    metadata_xml_root = etree.parse(metadata_xml_file).getroot()
+                    metadata = parse_metadata(metadata_xml_file)
 
             # Generate and write URL list
             url_book_prefix = constants.URL_BOOK_PREFIX.format(
@@ -197,6 +262,6 @@ def generate_skel_dir_from_catalog(catalog_zip: zipfile.ZipFile, output_dir: pat
                 series=book['series'],
             )
 
-            asset_urls = extract_asset_urls(metadata_xml_root, {'searchabletext', 'archive', 'toc'})
+            asset_urls = extract_asset_urls(metadata, {'searchabletext', 'archive', 'toc'})
             assets_download_list.write(generate_url_list(url_book_prefix, book_dir_prefix_only, asset_urls, downloader))
             assets_download_list.write('\n')
@@ -2,15 +2,23 @@
 
 from typing import Optional, List, TypedDict, Iterator, Tuple, cast
 
+import concurrent.futures
 import random
 import time
+import urllib.parse
 
-import mechanicalsoup
-from bs4 import BeautifulSoup, NavigableString
-from bs4.element import Tag
+from lxml import etree, html
+import requests
 
 from .constants import *
 
+_XP_NEXT_PAGE_TEXT = etree.XPath("//div[@id='pageBar']//text()[. = '下一页']", smart_strings=False)
+_XP_NEXT_PAGE_HREF = etree.XPath("//a[. = '下一页']/@href", smart_strings=False)
+_XP_BOOK_LISTING = etree.XPath('(//ul)[1]')
+_XP_BOOK_ITEMS = etree.XPath('./li')
+_XP_BOOK_LINK = etree.XPath('((.//div)[1]//a)[1]')
+_XP_BOOK_THUMBNAIL = etree.XPath('(.//img)[1]/@src', smart_strings=False)
+
 
 class BookMetadata(TypedDict):
     uuid: Optional[str]
@@ -21,35 +29,34 @@ class BookMetadata(TypedDict):
     name: str
 
 
-def new_browser() -> mechanicalsoup.StatefulBrowser:
-    return mechanicalsoup.StatefulBrowser(
-        soup_config={'features': 'lxml'},
-        raise_on_404=True,
-        user_agent='Mozilla/5.0 (X11; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0',
-    )
+def new_session() -> requests.Session:
+    session = requests.Session()
+    session.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0'
+    return session
+
+def has_next_page(root: html.HtmlElement) -> bool:
+    return len(cast(List[str], _XP_NEXT_PAGE_TEXT(root))) != 0
 
-def has_next_page(soup: BeautifulSoup) -> bool:
-    page_bar = soup.find('div', attrs={'id': 'pageBar'})
-    if page_bar is None or isinstance(page_bar, NavigableString):
-        return False
-    return page_bar.find(text='下一页') is not None
+def find_next_page_url(root: html.HtmlElement) -> Optional[str]:
+    hrefs = cast(List[str], _XP_NEXT_PAGE_HREF(root))
+    return hrefs[0] if len(hrefs) != 0 else None
 
-def parse_catalog(soup: BeautifulSoup) -> List[BookMetadata]:
-    ul: Optional[Tag] = soup.ul
+def parse_catalog(root: html.HtmlElement) -> List[BookMetadata]:
+    uls = cast(List[html.HtmlElement], _XP_BOOK_LISTING(root))
 
-    if ul is None:
+    if len(uls) == 0:
         raise RuntimeError('Cannot locate book listing.')
 
     result: List[BookMetadata] = []
 
-    for element in ul.find_all('li', recursive=False):
-        #print(element.find_all('a'))
+    for element in cast(List[html.HtmlElement], _XP_BOOK_ITEMS(uls[0])):
+        link = cast(List[html.HtmlElement], _XP_BOOK_LINK(element))[0]
         uuid: Optional[str] = None
-        uuid_match = RE_BOOK_UUID_FROM_HOME.match(element.div.a['href'])
+        uuid_match = RE_BOOK_UUID_FROM_HOME.match(link.get('href', ''))
         if uuid_match is not None:
             uuid = cast(str, uuid_match.group(1))
 
-        thumbnail_url = element.div.a.img['src']
+        thumbnail_url = cast(List[str], _XP_BOOK_THUMBNAIL(link))[0]
 
         meta_match = RE_BOOK_META.match(thumbnail_url)
         if meta_match is not None:
@@ -66,28 +73,40 @@ def parse_catalog(soup: BeautifulSoup) -> List[BookMetadata]:
     
     return result
 
+def _parse_catalog_html(content: bytes) -> Tuple[List[BookMetadata], Optional[str]]:
+    root = html.fromstring(content)
+    return parse_catalog(root), find_next_page_url(root)
+
+def _fetch(session: requests.Session, url: str, referer: Optional[str] = None) -> requests.Response:
+    response = session.get(url, headers={'Referer': referer} if referer is not None else None)
+    response.raise_for_status()
+    return response
+
 def download_catalog(years: List[int | str]) -> Iterator[Tuple[int | str, int, List[BookMetadata]]]:
-    browser = new_browser()
-
-    for year in years:
-        url = URL_CATALOG_INDEX_NOPAGE.format(year=year)
-        browser.open(url)
-        page = 1
-
-        while True:
-            print(f'Parsing {browser.url}...')
-            parsed_catalog = parse_catalog(browser.page)
-            yield year, page, parsed_catalog
-
-            print('Sleeping...')
-            time.sleep(3 + random.expovariate(3) * 15)
-            print('Navigating next page...')
-
-            page += 1
-
-            try:
-                next_page_link: Tag = browser.find_link(link_text='下一页')
-            except mechanicalsoup.LinkNotFoundError:
-                print('Last page.')
-                break
-            browser.follow_link(next_page_link)
+    session = new_session()
+
+    # Parsing is done in the background while we sleep between requests.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as parser:
+        for year in years:
+            url = URL_CATALOG_INDEX_NOPAGE.format(year=year)
+            response = _fetch(session, url)
+            page = 1
+
+            while True:
+                print(f'Parsing {response.url}...')
+                parsed_page = parser.submit(_parse_catalog_html, response.content)
+
+                print('Sleeping...')
+                time.sleep(3 + random.expovariate(3) * 15)
+
+                parsed_catalog, next_page_url = parsed_page.result()
+                yield year, page, parsed_catalog
+
+                print('Navigating next page...')
+
+                page += 1
+
+                if next_page_url is None:
+                    print('Last page.')
+                    break
+                response = _fetch(session, urllib.parse.urljoin(response.url, next_page_url), referer=response.url)
@@ -0,0 +1,67 @@
+import pathlib
+import tempfile
+import unittest
+
+from ccppg_ripper import converter
+
+# Encrypted with the original implementation.
+MASTER_PASSPHRASE = '0123456789abcdef'
+EPASSPHRASE = '306F454E4D634558736930537A4639546348346C34513D3D'
+EPASSWORD = '4C43666763773D3D'
+ACCESS_CODE = '4321'
+
+LICENSE_XML = f'''<?xml version="1.0" encoding="utf-8"?>
+<package>
+    <encryption content="stray"/>
+    <certificate>
+        <encryption content="stray"/>
+        <security>
+            <encryption content="{EPASSPHRASE}"/>
+            <password content="{EPASSWORD}"/>
+        </security>
+    </certificate>
+    <other><certificate><security><password content="stray"/></security></certificate></other>
+</package>
+'''
+
+
+class TestLicense(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dir = pathlib.Path(self._tmp_dir.name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def write_license(self, content: str) -> pathlib.Path:
+        license_path = self.tmp_dir / 'license.xml'
+        license_path.write_text(content, encoding='utf-8')
+        return license_path
+
+    def test_master_passphrase(self):
+        license_path = self.write_license(LICENSE_XML)
+        self.assertEqual(converter.get_book_master_passphrase_from_license(license_path), MASTER_PASSPHRASE)
+
+    def test_access_code(self):
+        license_path = self.write_license(LICENSE_XML)
+        self.assertEqual(converter.get_book_access_code_from_license(license_path), ACCESS_CODE)
+
+    def test_duplicate_encryption_tag(self):
+        license_path = self.write_license(LICENSE_XML.replace(
+            '<password', f'<encryption content="{EPASSPHRASE}"/><password'))
+        with self.assertRaisesRegex(RuntimeError, 'encryption tag'):
+            converter.get_book_master_passphrase_from_license(license_path)
+
+    def test_missing_password_tag(self):
+        license_path = self.write_license(LICENSE_XML.replace(f'<password content="{EPASSWORD}"/>', ''))
+        with self.assertRaisesRegex(RuntimeError, 'password tag'):
+            converter.get_book_access_code_from_license(license_path)
+
+    def test_missing_content(self):
+        license_path = self.write_license(LICENSE_XML.replace(f'content="{EPASSPHRASE}"', ''))
+        with self.assertRaisesRegex(RuntimeError, 'does not contain'):
+            converter.get_book_master_passphrase_from_license(license_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
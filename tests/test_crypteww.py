@@ -0,0 +1,90 @@
+import hashlib
+import io
+import unittest
+
+from ccppg_ripper import crypteww
+
+# Outputs produced by the original block-by-block implementation.
+PLAINTEXT = bytes(range(256)) * 40 + b'tail!'
+OFFLINE_PASSPHRASE = '0123456789abcdef'
+EPASSPHRASE = '306F454E4D634558736930537A4639546348346C34513D3D'
+EPASSWORD = '4C43666763773D3D'
+HELLO_CT = bytes.fromhex('94c54943c021b380b2e1d185')
+SWF_OBJ_SHA256 = '33ee1f5849d89a547f1124ad72ee1857158d17902aaa4c56d46b60ac5e5b43a2'
+
+
+class TestSaferSK128FVCBC(unittest.TestCase):
+    def test_decrypt_first(self):
+        # Decrypting before anything has been encrypted with the same key.
+        cipher = crypteww.SaferSK128FVCBC.from_passphrase('abc')
+        self.assertEqual(cipher.decrypt_autofinish(HELLO_CT), b'hello, world')
+
+    def test_encrypt_matches_reference(self):
+        cipher = crypteww.SaferSK128FVCBC.from_passphrase('abc')
+        self.assertEqual(cipher.encrypt_autofinish(b'hello, world'), HELLO_CT)
+
+    def test_round_trip(self):
+        for size in (0, 7, 8, 9, 64, 8192, 8197):
+            with self.subTest(size=size):
+                data = PLAINTEXT[:size]
+                ct = crypteww.SaferSK128FVCBC.from_passphrase('abc').encrypt_autofinish(data)
+                pt = crypteww.SaferSK128FVCBC.from_passphrase('abc').decrypt_autofinish(ct)
+                self.assertEqual(pt, data)
+
+    def test_chained_decrypt(self):
+        ct = crypteww.SaferSK128FVCBC.from_passphrase('abc').encrypt_autofinish(PLAINTEXT[:8192])
+        cipher = crypteww.SaferSK128FVCBC.from_passphrase('abc')
+        self.assertEqual(cipher.decrypt(ct[:4096]) + cipher.decrypt(ct[4096:]), PLAINTEXT[:8192])
+
+
+class TestLicense(unittest.TestCase):
+    def test_offline_license_passphrase(self):
+        self.assertEqual(crypteww.decrypt_offline_license_passphrase(EPASSPHRASE), OFFLINE_PASSPHRASE)
+        self.assertEqual(crypteww.encrypt_offline_license_passphrase(OFFLINE_PASSPHRASE), EPASSPHRASE)
+
+    def test_access_code_passphrase(self):
+        self.assertEqual(crypteww.decrypt_access_code_passphrase(OFFLINE_PASSPHRASE, EPASSWORD), '4321')
+        self.assertEqual(crypteww.encrypt_access_code_passphrase(OFFLINE_PASSPHRASE, '4321'), EPASSWORD)
+
+
+class TestSWFObj(unittest.TestCase):
+    def _encrypt(self, data: bytes) -> bytes:
+        out_file = io.BytesIO()
+        crypteww.encrypt_swf_obj_file('abc', io.BytesIO(data), out_file)
+        return out_file.getvalue()
+
+    def test_encrypt_matches_reference(self):
+        self.assertEqual(hashlib.sha256(self._encrypt(PLAINTEXT)).hexdigest(), SWF_OBJ_SHA256)
+
+    def test_decrypt(self):
+        out_file = io.BytesIO()
+        crypteww.decrypt_swf_obj_file('abc', io.BytesIO(self._encrypt(PLAINTEXT)), out_file)
+        self.assertEqual(out_file.getvalue(), PLAINTEXT)
+
+    def test_bytes(self):
+        encrypted = crypteww.encrypt_swf_obj_bytes('abc', PLAINTEXT)
+        self.assertEqual(encrypted, self._encrypt(PLAINTEXT))
+        self.assertEqual(crypteww.decrypt_swf_obj_bytes('abc', encrypted), PLAINTEXT)
+
+        key = crypteww.derive_key('abc')
+        self.assertEqual(crypteww.decrypt_swf_obj_bytes_prepared(key, crypteww.derive_iv(key), encrypted), PLAINTEXT)
+
+    def test_bytes_short(self):
+        # Objects shorter than the encrypted region.
+        data = PLAINTEXT[:100]
+        self.assertEqual(crypteww.decrypt_swf_obj_bytes('abc', crypteww.encrypt_swf_obj_bytes('abc', data)), data)
+
+    def test_decrypt_prepared(self):
+        key = crypteww.derive_key('abc')
+        iv = crypteww.derive_iv(key)
+        encrypted = self._encrypt(PLAINTEXT)
+
+        # The same key and IV can be reused for any number of objects.
+        for _ in range(2):
+            out_file = io.BytesIO()
+            crypteww.decrypt_swf_obj_file_prepared(key, iv, io.BytesIO(encrypted), out_file)
+            self.assertEqual(out_file.getvalue(), PLAINTEXT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import contextlib
+import io
+import unittest
+
+from ccppg_ripper import downloader
+
+METADATA_XML = b'''<?xml version="1.0" encoding="utf-8"?>
+<package>
+    <manifest>
+        <item href="pages/1.swf" media-type="application/x-shockwave-flash"/>
+        <item href="pages/2.swf"/>
+        <item href="pages/3.png"/>
+    </manifest>
+    <spine>
+        <itemref thumbnail="thumbs/1.jpg"/>
+        <itemref/>
+        <itemref thumbnail="thumbs/3.jpg"/>
+    </spine>
+    <drm_enabled>
+        <certificate type="2" url="license/license.xml"/>
+        <searchabletext url="text/text.xml"/>
+        <archive url="archive/archive.zip"/>
+        <customized>
+            <pagedescription external="toc/toc.xml"/>
+        </customized>
+    </drm_enabled>
+</package>
+'''
+
+MINIMAL_XML = b'''<package>
+    <manifest><item href="pages/1.swf" media-type="application/x-shockwave-flash"/></manifest>
+    <drm_enabled><certificate type="2" url="license/license.xml"/>%s</drm_enabled>
+</package>
+'''
+
+ALL_ASSETS: downloader.AssetFlags = {'thumbnails', 'searchabletext', 'archive', 'toc'}
+
+
+def parse(xml: bytes) -> downloader.MetadataView:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return downloader.parse_metadata(io.BytesIO(xml))
+
+def extract_asset_urls(metadata: downloader.MetadataView, include: downloader.AssetFlags):
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        urls = downloader.extract_asset_urls(metadata, include)
+    return urls, stdout.getvalue()
+
+
+class TestParseMetadata(unittest.TestCase):
+    def test_metadata_view(self):
+        self.assertEqual(parse(METADATA_XML), {
+            'license_url': 'license/license.xml',
+            'pages': [
+                ('pages/1.swf', 'application/x-shockwave-flash'),
+                ('pages/2.swf', 'application/x-shockwave-flash'),
+                ('pages/3.png', 'image/x-flp'),
+            ],
+            'thumbnails': ['thumbs/1.jpg', 'thumbs/3.jpg'],
+            'searchabletext_url': 'text/text.xml',
+            'archive_url': 'archive/archive.zip',
+            'has_toc': True,
+            'toc_url': 'toc/toc.xml',
+        })
+
+    def test_ignores_tags_outside_expected_path(self):
+        metadata = parse(b'''<package>
+    <manifest><item href="pages/1.swf" media-type="application/x-shockwave-flash"/></manifest>
+    <item href="stray.swf"/>
+    <drm_enabled><certificate type="2" url="license/license.xml"/></drm_enabled>
+    <archive url="stray.zip"/>
+</package>''')
+        self.assertEqual(metadata['pages'], [('pages/1.swf', 'application/x-shockwave-flash')])
+        self.assertIsNone(metadata['archive_url'])
+
+    def test_no_pages(self):
+        with self.assertRaisesRegex(RuntimeError, 'No pages found'):
+            parse(b'<package><manifest/><drm_enabled><certificate type="2" url="l.xml"/></drm_enabled></package>')
+
+    def test_certificate(self):
+        with self.assertRaisesRegex(RuntimeError, 'exactly once'):
+            parse(b'<package><manifest><item href="1.swf"/></manifest></package>')
+        with self.assertRaisesRegex(RuntimeError, 'Only embedded license'):
+            parse(b'<package><manifest><item href="1.swf"/></manifest><drm_enabled><certificate type="1" url="l.xml"/></drm_enabled></package>')
+
+
+class TestExtractAssetUrls(unittest.TestCase):
+    def test_required_only(self):
+        urls, _stdout = extract_asset_urls(parse(METADATA_XML), set())
+        self.assertEqual(urls, ['pages/1.swf', 'pages/2.swf', 'pages/3.png', 'license/license.xml'])
+
+    def test_all_assets(self):
+        urls, stdout = extract_asset_urls(parse(METADATA_XML), ALL_ASSETS)
+        self.assertEqual(urls, [
+            'pages/1.swf', 'pages/2.swf', 'pages/3.png', 'license/license.xml',
+            'thumbs/1.jpg', 'thumbs/3.jpg', 'text/text.xml', 'archive/archive.zip', 'toc/toc.xml',
+        ])
+        self.assertEqual(stdout, '')
+
+    def test_flags_are_independent(self):
+        metadata = parse(METADATA_XML)
+        self.assertEqual(extract_asset_urls(metadata, {'archive'})[0][-1], 'archive/archive.zip')
+        self.assertEqual(extract_asset_urls(metadata, {'toc'})[0][-1], 'toc/toc.xml')
+        self.assertNotIn('archive/archive.zip', extract_asset_urls(metadata, {'searchabletext'})[0])
+
+    def test_toc_absent(self):
+        urls, stdout = extract_asset_urls(parse(MINIMAL_XML % b''), {'toc'})
+        self.assertEqual(urls, ['pages/1.swf', 'license/license.xml'])
+        self.assertNotIn('TOC', stdout)
+
+    def test_toc_without_external(self):
+        urls, stdout = extract_asset_urls(parse(MINIMAL_XML % b'<customized><pagedescription/></customized>'), {'toc'})
+        self.assertEqual(urls, ['pages/1.swf', 'license/license.xml'])
+        self.assertIn('TOC requested but no TOC file found.', stdout)
+
+    def test_no_thumbnails(self):
+        _urls, stdout = extract_asset_urls(parse(MINIMAL_XML % b''), {'thumbnails'})
+        self.assertIn('No thumbnails found.', stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()